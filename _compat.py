@@ -0,0 +1,16 @@
+"""
+Optional dependencies shared by letkf_forecasting and prepare_sat_data.
+"""
+try:
+    from numba import njit, prange
+    HAS_NUMBA = True
+except ImportError:
+    # without numba the kernels are left as plain python functions and the
+    # callers use numpy instead
+    HAS_NUMBA = False
+    prange = range
+
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda function: function
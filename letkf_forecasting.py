@@ -1,52 +1,191 @@
 import numpy as np
 import pandas as pd
-import scipy as sp
 import xarray as xr
 from scipy import ndimage
+from scipy import sparse
+from scipy.linalg import blas
+from scipy.spatial import cKDTree, Delaunay
 import matplotlib.pyplot as plt
-import scipy.interpolate as interpolate
 import pvlib as pv
+from _compat import HAS_NUMBA, njit, prange
 
 a = 6371000  # average radius of earth when modeled as a sphere From wikipedia
 
 
-def time_deriv_3(q, dt, u, dx, v, dy):
-    k = space_deriv_4(q, u, dx, v, dy)
-    k = space_deriv_4(q + dt/3*k, u, dx, v, dy)
-    k = space_deriv_4(q + dt/2*k, u, dx, v, dy)
-    qout = q + dt*k
-    return qout
+def time_deriv_3(q, dt, u, dx, v, dy, scratch_a=None, scratch_b=None,
+                 F_x=None, F_y=None):
+    """Advances q by one RK3 step of length dt.
 
-
-def space_deriv_4(q, u, dx, v, dy):
-    qout = np.zeros_like(q)
-    F_x = np.zeros_like(u)
-    F_y = np.zeros_like(v)
+    If scratch_a and scratch_b, two arrays the shape of q, are given then q is
+    advanced in place and nothing is allocated for the stages. Otherwise q is
+    left unchanged and the advanced field is returned as a new array. F_x and
+    F_y are passed on to space_deriv_4.
+    """
+    if scratch_a is None:
+        q = q.copy()
+        scratch_a = np.empty_like(q)
+        scratch_b = np.empty_like(q)
+    k = space_deriv_4(q, u, dx, v, dy, scratch_a, F_x, F_y)
+    np.multiply(k, dt/3, out=scratch_b)
+    np.add(scratch_b, q, out=scratch_b)
+    k = space_deriv_4(scratch_b, u, dx, v, dy, scratch_a, F_x, F_y)
+    np.multiply(k, dt/2, out=scratch_b)
+    np.add(scratch_b, q, out=scratch_b)
+    k = space_deriv_4(scratch_b, u, dx, v, dy, scratch_a, F_x, F_y)
+    np.multiply(k, dt, out=k)
+    np.add(q, k, out=q)
+    return q
+
+
+def space_deriv_4(q, u, dx, v, dy, out=None, F_x=None, F_y=None):
+    """Returns the advective tendency of q, written into out if it is given.
+    F_x and F_y are scratch arrays the shape of u and v for the fluxes which
+    are allocated here if they are None."""
+    if out is None:
+        out = np.zeros_like(q)
+    else:
+        out.fill(0)
+    # only the middle of the fluxes is written and read so scratch arrays do
+    # not need to be cleared
+    if F_x is None:
+        F_x = np.zeros_like(u)
+    if F_y is None:
+        F_y = np.zeros_like(v)
 
     # middle calculation
     F_x[:, 2:-2] = u[:, 2:-2]/12*(
         7*(q[:, 2:-1] + q[:, 1:-2]) - (q[:, 3:] + q[:, :-3]))
     F_y[2:-2, :] = v[2:-2, :]/12*(
         7*(q[2:-1, :] + q[1:-2, :]) - (q[3:, :] + q[:-3, :]))
-    qout[:, 2:-2] = qout[:, 2:-2] - (F_x[:, 3:-2] - F_x[:, 2:-3])/dx
-    qout[2:-2, :] = qout[2:-2, :] - (F_y[3:-2, :] - F_y[2:-3, :])/dy
+    out[:, 2:-2] -= (F_x[:, 3:-2] - F_x[:, 2:-3])/dx
+    out[2:-2, :] -= (F_y[3:-2, :] - F_y[2:-3, :])/dy
 
     # boundary calculation
     u_w = u[:, 0:2].clip(max=0)
     u_e = u[:, -2:].clip(min=0)
-    qout[:, 0:2] = qout[:, 0:2] - ((u_w/dx)*(
+    out[:, 0:2] -= ((u_w/dx)*(
         q[:, 1:3] - q[:, 0:2]) + (q[:, 0:2]/dx)*(u[:, 1:3] - u[:, 0:2]))
-    qout[:, -2:] = qout[:, -2:] - ((u_e/dx)*(
+    out[:, -2:] -= ((u_e/dx)*(
         q[:, -2:] - q[:, -3:-1]) + (q[:, -2:]/dx)*(u[:, -2:] - u[:, -3:-1]))
 
     v_n = v[-2:, :].clip(min=0)
     v_s = v[0:2, :].clip(max=0)
-    qout[0:2, :] = qout[0:2, :] - ((v_s/dx)*(
+    out[0:2, :] -= ((v_s/dx)*(
         q[1:3, :] - q[0:2, :]) + (q[0:2, :]/dx)*(v[1:3, :] - v[0:2, :]))
-    qout[-2:, :] = qout[-2:, :] - ((v_n/dx)*(
+    out[-2:, :] -= ((v_n/dx)*(
         q[-2:, :] - q[-3:-1, :]) + (q[-2:, :]/dx)*(v[-2:, :] - v[-3:-1, :]))
 
-    return qout
+    return out
+
+
+def _advection_scalars(dt, dx, dy, dtype):
+    """Returns the time steps (dt, dt/2, dt/3) and inverse grid spacings
+    (1/dx, 1/(12*dx), 1/dy, 1/(12*dy)) used by the numba kernels as scalars
+    of dtype so that float32 fields are never promoted to float64."""
+    dtype = np.dtype(dtype).type
+    dts = (dtype(dt), dtype(dt/2), dtype(dt/3))
+    inv_ds = (dtype(1/dx), dtype(1/(12*dx)), dtype(1/dy), dtype(1/(12*dy)))
+    return dts, inv_ds
+
+
+@njit(cache=True, fastmath=True)
+def _space_deriv_4_nb(q, u, du, v, dv, inv_ds, out):
+    """Loop version of space_deriv_4 which writes the derivative into out.
+
+    u and v are on the staggered grid, so u has one more column than q and
+    v has one more row than q. The scalars du and dv are added to u and v,
+    which is how the wind perturbation of an ensemble member is applied.
+    inv_ds comes from _advection_scalars.
+    """
+    ny, nx = q.shape
+    inv_dx, inv_12dx, inv_dy, inv_12dy = inv_ds
+    # literals would be float64 so the constants take the dtype of q
+    zero = q.dtype.type(0)
+    seven = q.dtype.type(7)
+    for i in range(ny):
+        # middle calculation in x
+        for j in range(2, nx - 2):
+            fx_e = (u[i, j + 1] + du)*(
+                seven*(q[i, j + 1] + q[i, j]) - (q[i, j + 2] + q[i, j - 1]))
+            fx_w = (u[i, j] + du)*(
+                seven*(q[i, j] + q[i, j - 1]) - (q[i, j + 1] + q[i, j - 2]))
+            out[i, j] = (fx_w - fx_e)*inv_12dx
+
+        # boundary calculation in x
+        for j in range(2):
+            u_w = min(u[i, j] + du, zero)
+            out[i, j] = -inv_dx*(u_w*(q[i, j + 1] - q[i, j]) +
+                                 q[i, j]*(u[i, j + 1] - u[i, j]))
+        for j in range(nx - 2, nx):
+            u_e = max(u[i, j + 1] + du, zero)
+            out[i, j] = -inv_dx*(u_e*(q[i, j] - q[i, j - 1]) +
+                                 q[i, j]*(u[i, j + 1] - u[i, j]))
+
+        # y direction, middle or boundary depending on the row
+        if i >= 2 and i < ny - 2:
+            for j in range(nx):
+                fy_n = (v[i + 1, j] + dv)*(
+                    seven*(q[i + 1, j] + q[i, j]) -
+                    (q[i + 2, j] + q[i - 1, j]))
+                fy_s = (v[i, j] + dv)*(
+                    seven*(q[i, j] + q[i - 1, j]) -
+                    (q[i + 1, j] + q[i - 2, j]))
+                out[i, j] += (fy_s - fy_n)*inv_12dy
+        elif i < 2:
+            for j in range(nx):
+                v_s = min(v[i, j] + dv, zero)
+                out[i, j] -= inv_dx*(v_s*(q[i + 1, j] - q[i, j]) +
+                                     q[i, j]*(v[i + 1, j] - v[i, j]))
+        else:
+            for j in range(nx):
+                v_n = max(v[i + 1, j] + dv, zero)
+                out[i, j] -= inv_dx*(v_n*(q[i, j] - q[i - 1, j]) +
+                                     q[i, j]*(v[i + 1, j] - v[i, j]))
+
+
+@njit(cache=True, fastmath=True)
+def _time_deriv_3_nb(q, dts, u, du, v, dv, inv_ds, k, q_stage, qout):
+    """Loop version of time_deriv_3. dts and inv_ds come from
+    _advection_scalars, k and q_stage are scratch arrays the shape of q and
+    the advanced field is written into qout."""
+    ny, nx = q.shape
+    dt, dt_2, dt_3 = dts
+    _space_deriv_4_nb(q, u, du, v, dv, inv_ds, k)
+    for i in range(ny):
+        for j in range(nx):
+            q_stage[i, j] = q[i, j] + dt_3*k[i, j]
+    _space_deriv_4_nb(q_stage, u, du, v, dv, inv_ds, k)
+    for i in range(ny):
+        for j in range(nx):
+            q_stage[i, j] = q[i, j] + dt_2*k[i, j]
+    _space_deriv_4_nb(q_stage, u, du, v, dv, inv_ds, k)
+    for i in range(ny):
+        for j in range(nx):
+            qout[i, j] = q[i, j] + dt*k[i, j]
+
+
+@njit(parallel=True, cache=True, fastmath=True)
+def _advect_ensemble_nb(members, dts, u, du, v, dv, inv_ds, T_steps):
+    """Advances every member of members, an (ens_size, ny, nx) array, in
+    place by T_steps calls of time_deriv_3 with wind u + du[m] and
+    v + dv[m]. Members are advanced in parallel, each over its whole
+    field."""
+    ens_size, ny, nx = members.shape
+    for m in prange(ens_size):
+        q = members[m]
+        k = np.empty((ny, nx), dtype=members.dtype)
+        q_stage = np.empty((ny, nx), dtype=members.dtype)
+        q_next = np.empty((ny, nx), dtype=members.dtype)
+        # two steps at a time so the result ends up back in the member
+        for t in range(T_steps//2):
+            _time_deriv_3_nb(q, dts, u, du[m], v, dv[m], inv_ds, k, q_stage,
+                             q_next)
+            _time_deriv_3_nb(q_next, dts, u, du[m], v, dv[m], inv_ds, k,
+                             q_stage, q)
+        if T_steps % 2 == 1:
+            _time_deriv_3_nb(q, dts, u, du[m], v, dv[m], inv_ds, k, q_stage,
+                             q_next)
+            q[:, :] = q_next
 
 
 def cot(theta):
@@ -114,9 +253,9 @@ def forward_obs_mat(sensor_loc, sat_loc):
 
     Returns
     -------
-    H : array
-         A kxn forward observation matrix which maps sensor locations to
-         satellite locations.
+    H : sparse matrix
+         A kxn forward observation matrix in CSR format which maps sensor
+         locations to satellite locations.
     sensor_loc : array
          The same as the inputed sensor_loc with an additional third column
          which is the index number of the domain corresponding to the row
@@ -124,15 +263,11 @@ def forward_obs_mat(sensor_loc, sat_loc):
     """
     sensor_num = sensor_loc.shape[0]
     domain_size = sat_loc.shape[0]
-    sensor_loc = np.concatenate((sensor_loc, np.zeros(sensor_num)[:, None]),
-                                axis=1)
-    H = np.zeros([sensor_num, domain_size])
-    for id in range(0, sensor_num):
-        index = np.sqrt(
-            (sat_loc[:, 0] - sensor_loc[id, 0])**2
-            + (sat_loc[:, 1] - sensor_loc[id, 1])**2).argmin()
-        sensor_loc[id, 2] = index
-        H[id, index] = 1
+    index = cKDTree(sat_loc).query(sensor_loc, k=1)[1]
+    sensor_loc = np.concatenate((sensor_loc, index[:, None]), axis=1)
+    H = sparse.csr_matrix(
+        (np.ones(sensor_num), (np.arange(sensor_num), index)),
+        shape=(sensor_num, domain_size))
 
     return H, sensor_loc
 
@@ -143,12 +278,11 @@ def to_nearest_indices(array, values):
     """Modified from
     https://stackoverflow.com/questions/2566412/find-nearest-value-in-numpy-array"""
     idx = np.searchsorted(array, values, side="left")
-    for i in range(idx.size):
-        if idx[i] > 0 and (idx[i] == len(array) or
-                           np.abs(values[i] - array[idx[i] - 1]) <
-                           np.abs(values[i] - array[idx[i]])):
-            idx[i] =  idx[i] - 1
-    return idx
+    left = array[(idx - 1).clip(min=0)]
+    right = array[idx.clip(max=len(array) - 1)]
+    use_left = (idx > 0) & ((idx == len(array)) |
+                            (np.abs(values - left) < np.abs(values - right)))
+    return idx - use_left
 
 def to_lat_lon(x, y, loc_lat):
     """Converts a displacement in meters to a displacement in degrees.
@@ -210,11 +344,101 @@ def nearest_positions(loc, shape, dist):
     return near_positions
 
 
+def build_local_index_table(assimilation_positions_2d, domain_shape,
+                            localization_length):
+    """Returns the raveled indices of the elements within localization_length
+    of every assimilation position in either the x or y direction. This is
+    nearest_positions for all assimilation positions at once.
+
+    Parameters
+    ----------
+    assimilation_positions_2d : array
+         A kx2 array of the row and column of each assimilation position.
+    domain_shape : (int, int)
+         The shape of the unraveled domain.
+    localization_length : int
+         The distance which can be traveled in x or y in the unraveled array.
+
+    Returns
+    -------
+    local_indices : array
+         A kx(2*localization_length + 1)**2 int32 array of raveled indices.
+         Entries which fall outside of the domain are set to 0.
+    local_mask : array
+         A boolean array the same shape as local_indices which is False where
+         the entry falls outside of the domain.
+    """
+    offsets = np.arange(-localization_length, localization_length + 1)
+    rows = assimilation_positions_2d[:, 0, None, None] + offsets[None, :, None]
+    cols = assimilation_positions_2d[:, 1, None, None] + offsets[None, None, :]
+    local_mask = ((rows >= 0) & (rows < domain_shape[0]) &
+                  (cols >= 0) & (cols < domain_shape[1]))
+    local_indices = np.where(local_mask, rows*domain_shape[1] + cols, 0)
+    n_assim = assimilation_positions_2d.shape[0]
+    local_indices = local_indices.reshape(n_assim, -1).astype(np.int32)
+    local_mask = local_mask.reshape(n_assim, -1)
+    return local_indices, local_mask
+
+
+def build_interpolation_matrix(assimilation_positions_2d, full_positions_2d,
+                               dtype=np.float64):
+    """Returns the sparse matrix which linearly interpolates values at
+    assimilation_positions_2d to full_positions_2d. This gives the same
+    result as scipy.interpolate.LinearNDInterpolator, but the triangulation
+    is done once so the matrix can be reused for every assimilation.
+
+    Parameters
+    ----------
+    assimilation_positions_2d : array
+         A kx2 array of the row and column of each assimilation position.
+    full_positions_2d : array
+         A nx2 array of the row and column of every element of the domain.
+    dtype : dtype
+         The dtype of the matrix. It should be the dtype of the ensemble so
+         that the interpolated weights are not computed in float64 and then
+         copied.
+
+    Returns
+    -------
+    interpolation_matrix : sparse matrix
+         A nxk CSR matrix with the three barycentric weights of the enclosing
+         triangle in each row. Rows of points outside of the convex hull of
+         assimilation_positions_2d are zero.
+    """
+    tri = Delaunay(assimilation_positions_2d)
+    simplices = tri.find_simplex(full_positions_2d)
+    transform = tri.transform[simplices]
+    barycentric = np.einsum('ijk,ik->ij', transform[:, :2],
+                            full_positions_2d - transform[:, 2])
+    weights = np.concatenate(
+        [barycentric, 1 - barycentric.sum(axis=1)[:, None]], axis=1)
+    weights[simplices == -1] = 0
+    full_size = full_positions_2d.shape[0]
+    interpolation_matrix = sparse.csr_matrix(
+        (weights.ravel().astype(dtype),
+         (np.repeat(np.arange(full_size), 3),
+          tri.simplices[simplices].ravel())),
+        shape=(full_size, assimilation_positions_2d.shape[0]), dtype=dtype)
+    return interpolation_matrix
+
+
+def _scaled_gram(Y_b, R_inverse):
+    """Returns R_inverse*Y_b.dot(Y_b.T) for a scalar R_inverse using the
+    symmetric rank-k update, which does half the work of the full product.
+    Only the upper triangle is filled in so the result must be decomposed
+    with eigh(..., UPLO='U')."""
+    syrk = blas.get_blas_funcs('syrk', (Y_b,))
+    # Y_b.T is Fortran ordered so it is passed to BLAS without a copy
+    return syrk(alpha=R_inverse, a=Y_b.T, trans=1)
+
+
 def assimilate_parallax(ensemble, observations, flat_sensor_indices, R_inverse,
                         inflation, domain_shape=False,
                         localization_length=False, assimilation_positions=False,
                         assimilation_positions_2d=False,
-                        full_positions_2d=False):
+                        full_positions_2d=False, local_indices=False,
+                        local_mask=False, interpolation_matrix=False,
+                        batch_size=64, x_bar=False, out=None):
     """
     *** NEED TO REWRITE
     Assimilates observations into ensemble using the LETKF.
@@ -229,7 +453,9 @@ def assimilate_parallax(ensemble, observations, flat_sensor_indices, R_inverse,
     H : array
          Forward observation matrix of size mxn. **may need changing**
     R_inverse : array
-         Inverse of observation error matrix. **will need changing**
+         Inverse of observation error matrix. **will need changing** With
+         localization it is either a scalar or the diagonal as an array of
+         length n.
     inflation : float
          Inflation parameter.
     localization_length : float
@@ -246,41 +472,64 @@ def assimilate_parallax(ensemble, observations, flat_sensor_indices, R_inverse,
     full_positions : array
          Array similar to assimilation_positions including the positions of
          all elements of the state.
+    local_indices, local_mask : array
+         Output of build_local_index_table for assimilation_positions_2d. If
+         False they will be built here.
+    interpolation_matrix : sparse matrix
+         Output of build_interpolation_matrix for assimilation_positions_2d
+         and full_positions_2d. If False it will be built here.
+    batch_size : int
+         Number of assimilation positions whose local analyses are computed
+         together in one batched eigendecomposition.
+    x_bar : array
+         Mean of the ensemble over its members if it is already known. If
+         False it will be computed here.
+    out : array
+         Scratch array the same shape and dtype as ensemble. If None it will
+         be allocated here.
 
     Return
     ------
     ensemble : array
-         Analysis ensemble of the same size as input ensemble
+         Analysis ensemble of the same size as input ensemble. The analysis
+         is written into the input ensemble, which is also returned.
     """
+    if out is None:
+        out = np.empty_like(ensemble)
     ## Change to allow for R to not be pre-inverted?
     if localization_length is False:
 
         # LETKF without localization
-        Y_b = ensemble[flat_sensor_indices, :]
-        y_b_bar = Y_b.mean(axis=1)
-        Y_b -= y_b_bar[:, None]
-        x_bar = ensemble.mean(axis=1) ## Need to bring this back
-        ensemble -= x_bar[:, None]
-        ens_size = ensemble.shape[1]
-        # C = (Y_b.T).dot(R_inverse)
-        C = Y_b.T*R_inverse
+        if x_bar is False:
+            x_bar = ensemble.mean(axis=0) ## Need to bring this back
+        Y_b = ensemble[:, flat_sensor_indices]
+        y_b_bar = x_bar[flat_sensor_indices]
+        Y_b -= y_b_bar[None, :]
+        ensemble -= x_bar[None, :]
+        ens_size = ensemble.shape[0]
+        # C = Y_b.dot(R_inverse)
+        C = Y_b*R_inverse
+        if np.ndim(R_inverse) == 0:
+            gram, uplo = _scaled_gram(Y_b, R_inverse), 'U'
+        else:
+            gram, uplo = C.dot(Y_b.T), 'L'
         ## Not working??
+        # the eigendecomposition is done in float64 even if the ensemble is
+        # float32
         eig_value, eig_vector = np.linalg.eigh(
-            (ens_size-1)*np.eye(ens_size)/inflation + C.dot(Y_b))
-        P_tilde = eig_vector.copy()
-        W_a = eig_vector.copy()
-        for i, num in enumerate(eig_value):
-            P_tilde[:, i] *= 1/num
-            W_a[:, i] *= 1/np.sqrt(num)
-        P_tilde = P_tilde.dot(eig_vector.T)
-        W_a = W_a.dot(eig_vector.T)*(np.sqrt(ens_size - 1))
+            (ens_size-1)*np.eye(ens_size)/inflation +
+            gram.astype(np.float64), UPLO=uplo)
+        P_tilde = (eig_vector/eig_value).dot(eig_vector.T)
+        W_a = (eig_vector/np.sqrt(eig_value)).dot(eig_vector.T)*(
+            np.sqrt(ens_size - 1))
         # P_tilde = np.linalg.inv(
         #     (ens_size - 1)*np.eye(ens_size)/inflation +
-        #     C.dot(Y_b))
+        #     C.dot(Y_b.T))
         # W_a = np.real(sp.linalg.sqrtm((ens_size - 1)*P_tilde))
         w_a_bar = P_tilde.dot(C.dot(observations - y_b_bar))
         W_a += w_a_bar[:, None]
-        ensemble = x_bar[:, None] + ensemble.dot(W_a)
+        np.dot(W_a.T.astype(ensemble.dtype), ensemble, out=out)
+        np.add(out, x_bar[None, :], out=ensemble)
         return ensemble
 
     else:
@@ -294,54 +543,75 @@ def assimilate_parallax(ensemble, observations, flat_sensor_indices, R_inverse,
         ## something clever since R_inverse.size is 400 billion
         ## best option: form R_inverse inside of localization routine
         ## good option: assimilate sat images at low resolution (probabily should do this either way)
-        x_bar = ensemble.mean(axis=1) ## Need to bring this back
-        ensemble -= x_bar[:, None]
-        ens_size = ensemble.shape[1]
-        kal_count = 0
-        W_interp = np.zeros([assimilation_positions.size, ens_size**2])
-        for interp_position in assimilation_positions:
-            local_positions = nearest_positions(interp_position, domain_shape,
-                                                localization_length)
-            local_ensemble = ensemble[local_positions]
-            local_x_bar = x_bar[local_positions]
-            local_obs = observations[local_positions] # assume H is I
-            C = (local_ensemble.T)*R_inverse  # assume R_inverse is diag+const
-
-            # This should be better, but I can't get it to work
+        if x_bar is False:
+            x_bar = ensemble.mean(axis=0) ## Need to bring this back
+        ensemble -= x_bar[None, :]
+        ens_size = ensemble.shape[0]
+        if local_indices is False:
+            local_indices, local_mask = build_local_index_table(
+                assimilation_positions_2d, domain_shape, localization_length)
+        n_assim = local_indices.shape[0]
+        W_interp = np.zeros([n_assim, ens_size**2], dtype=ensemble.dtype)
+        # The local ensembles are gathered batch_size at a time so that they
+        # can be decomposed by a single eigh call. Masked rows are set to zero
+        # so they add nothing to C.dot(local_ensemble) or to
+        # C.dot(local_obs - local_x_bar).
+        for start in range(0, n_assim, batch_size):
+            indices = local_indices[start:start + batch_size]
+            mask = local_mask[start:start + batch_size, :, None]
+            local_ensembles = (ensemble[:, indices].transpose(1, 0, 2) *
+                               mask.transpose(0, 2, 1))
+            local_innovations = (observations[indices] -
+                                 x_bar[indices])[:, :, None]*mask  # H is I
+            # assume R_inverse is diag+const
+            if np.ndim(R_inverse) == 0:
+                # a scalar R_inverse is applied to the small products so C is
+                # never formed
+                gram = np.matmul(local_ensembles,
+                                 local_ensembles.transpose(0, 2, 1))*R_inverse
+                innovation_term = R_inverse*np.matmul(local_ensembles,
+                                                      local_innovations)
+            else:
+                # R_inverse is the diagonal over the state, so the entries of
+                # each local region are gathered like the ensemble
+                C = local_ensembles*R_inverse[indices][:, None, :]
+                gram = np.matmul(C, local_ensembles.transpose(0, 2, 1))
+                innovation_term = np.matmul(C, local_innovations)
             eig_value, eig_vector = np.linalg.eigh(
-                (ens_size-1)*np.eye(ens_size)/inflation + C.dot(local_ensemble))
-            P_tilde = eig_vector.copy()
-            W_a = eig_vector.copy()
-            for i, num in enumerate(eig_value):
-                P_tilde[:, i] *= 1/num
-                W_a[:, i] *= 1/np.sqrt(num)
-            P_tilde = P_tilde.dot(eig_vector.T)
-            W_a = W_a.dot(eig_vector.T)*np.sqrt(ens_size - 1)
+                (ens_size-1)*np.eye(ens_size)/inflation +
+                gram.astype(np.float64))
+            eig_vector_T = eig_vector.transpose(0, 2, 1)
+            P_tilde = np.matmul(eig_vector/eig_value[:, None, :],
+                                eig_vector_T)
+            W_a = np.matmul(eig_vector/np.sqrt(eig_value)[:, None, :],
+                            eig_vector_T)*np.sqrt(ens_size - 1)
 
             # P_tilde = np.linalg.inv(
             #     (ens_size - 1)*np.eye(ens_size)/inflation +
-            #     C.dot(local_ensemble))
+            #     C.dot(local_ensemble.T))
             # W_a = np.real(sp.linalg.sqrtm((ens_size - 1)*P_tilde))
-            w_a_bar = P_tilde.dot(C.dot(local_obs - local_x_bar))
-            W_a += w_a_bar[:, None]
-            W_interp[kal_count] = np.ravel(W_a) ## separate w_bar??
-            kal_count += 1
-
-        W_fun = interpolate.LinearNDInterpolator(assimilation_positions_2d,
-                                                 W_interp)
-        W_fine_mesh = W_fun(full_positions_2d)
+            W_a += np.matmul(P_tilde, innovation_term)
+            W_interp[start:start + indices.shape[0]] = W_a.reshape(
+                indices.shape[0], ens_size**2)  ## separate w_bar??
+
+        if interpolation_matrix is False:
+            interpolation_matrix = build_interpolation_matrix(
+                assimilation_positions_2d, full_positions_2d, ensemble.dtype)
+        W_fine_mesh = interpolation_matrix.dot(W_interp)
         W_fine_mesh = W_fine_mesh.reshape(domain_shape[0]*domain_shape[1],
-                                          ens_size, ens_size)
-        ensemble = x_bar[:, None] + np.einsum(
-            'ij, ijk->ik', ensemble, W_fine_mesh)
+                                          ens_size, ens_size).astype(
+                                              ensemble.dtype, copy=False)
+        np.matmul(ensemble.T[:, None, :], W_fine_mesh,
+                  out=out.T[:, None, :])
+        np.add(out, x_bar[None, :], out=ensemble)
 
         return ensemble
 
 
-def calc_sensor_error(sensor_values, sensor_loc, H, q, time):
+def calc_sensor_error(sensor_values, sensor_loc, flat_sensor_indices, q, time):
     """check back later
     """
-    data = H.dot(q.ravel())[None, :]
+    data = q.ravel()[flat_sensor_indices][None, :]
     sat_values = pd.DataFrame(data=data,
                               index=[time],
                               columns=sensor_loc['id'])
@@ -352,21 +622,20 @@ def ensemble_creator(sat_image, CI_sigma, wind_size, wind_sigma, ens_size):
     """check back later"""
     half_wind = int(round(wind_size/2))
     ens_wind = int(round(ens_size*half_wind))
-    ensemble = np.random.normal(
+    ensemble = np.empty([ens_size, 2*half_wind + sat_image.size],
+                        dtype=np.float32)
+    ensemble[:, :half_wind] = np.random.normal(
         loc=0,
         scale=wind_sigma[0],
-        size=ens_wind).reshape(half_wind, ens_size)
-    ensemble = np.concatenate(
-        [ensemble, np.random.normal(
-            loc=0,
-            scale=wind_sigma[1],
-            size=ens_wind).reshape(half_wind, ens_size)], axis=0)
-    ensemble = np.concatenate(
-        [ensemble,
-         np.repeat(sat_image.ravel()[:, None], ens_size, axis=1)], axis=0)
+        size=ens_wind).reshape(half_wind, ens_size).T
+    ensemble[:, half_wind:2*half_wind] = np.random.normal(
+        loc=0,
+        scale=wind_sigma[1],
+        size=ens_wind).reshape(half_wind, ens_size).T
+    ensemble[:, wind_size:] = sat_image.ravel()[None, :]
     CI_pert = np.random.normal(loc=0, scale=CI_sigma, size=ens_size)
-    ensemble[wind_size:] = ((1 - CI_pert[None, :])*ensemble[wind_size:] +
-                            CI_pert[None, :])
+    ensemble[:, wind_size:] = ((1 - CI_pert[:, None])*ensemble[:, wind_size:] +
+                               CI_pert[:, None])
     return ensemble
 
 
@@ -399,28 +668,89 @@ def assimilation_position_generator(domain_shape, assimilation_grid_size):
 
 
 def noise_fun(domain_shape):
-    noise_init = np.zeros(domain_shape)
-    noise_init[0:25, :] = 1
-    noise_init[-25:, :] = 1
-    noise_init[:, 0:25] = 1
-    noise_init[:, -25:] = 1
-    noise_init = sp.ndimage.gaussian_filter(noise_init, 12)
+    noise_init = np.ones(domain_shape, dtype=np.float32)
+    noise_init[25:-25, 25:-25] = 0
+    # the gaussian is separable so it is applied along each axis in place
+    ndimage.gaussian_filter1d(noise_init, 12, axis=0, output=noise_init)
+    ndimage.gaussian_filter1d(noise_init, 12, axis=1, output=noise_init)
     return noise_init
 
 
-def advect_5min(q, noise, ensemble, dt, U, dx, V, dy, T_steps, wind_size):
+def advect_5min(q, noise, ensemble, dt, U, dx, V, dy, T_steps, wind_size,
+                scratch_a=None, scratch_b=None):
     """Check back later"""
+    if not HAS_NUMBA:
+        return _advect_5min_numpy(q, noise, ensemble, dt, U, dx, V, dy,
+                                  T_steps, wind_size, scratch_a, scratch_b)
     domain_shape = q.shape
-    domain_size = domain_shape[0]*domain_shape[1]
-    ens_size = ensemble.shape[1]
+    ens_size = ensemble.shape[0]
+    # pass scalars and winds in the dtype of the fields so that numba does not
+    # upcast the arrays
+    dts, inv_ds = _advection_scalars(dt, dx, dy, q.dtype)
+    q = np.ascontiguousarray(q)
+    noise = np.ascontiguousarray(noise, dtype=q.dtype)
+    U = np.ascontiguousarray(U, dtype=q.dtype)
+    V = np.ascontiguousarray(V, dtype=q.dtype)
+    # the wind is constant over the 5 minutes so each field can be advanced
+    # through all T_steps on its own. q and noise are advanced together like
+    # two members without a wind perturbation.
+    fields = np.stack([q, noise])
+    no_perturbation = np.zeros(2, dtype=q.dtype)
+    _advect_ensemble_nb(fields, dts, U, no_perturbation, V, no_perturbation,
+                        inv_ds, T_steps)
+    q, noise = fields
+    # members only differ in their scalar wind perturbation so all of them
+    # are advanced in one call, in place on a view of the ensemble. They are
+    # advanced in the dtype of q, on a copy if the ensemble has another one.
+    members = ensemble[:, wind_size:].reshape((ens_size,) + domain_shape)
+    cast_members = members.astype(q.dtype, copy=False)
+    _advect_ensemble_nb(cast_members, dts, U,
+                        np.ascontiguousarray(ensemble[:, 0], dtype=q.dtype),
+                        V,
+                        np.ascontiguousarray(ensemble[:, 1], dtype=q.dtype),
+                        inv_ds, T_steps)
+    if cast_members is not members:
+        members[...] = cast_members
+    return q, noise, ensemble
+
+
+def _compile_advection(dtype):
+    """Compiles the advection kernels for fields of dtype, or loads them from
+    the numba cache, by advancing a small field so that this does not happen
+    inside the time loop of simulation_parallax."""
+    if not HAS_NUMBA:
+        return
+    q = np.zeros((8, 8), dtype=dtype)
+    ensemble = np.zeros((2, 2 + q.size), dtype=dtype)
+    advect_5min(q, q, ensemble, 1, np.zeros((8, 9)), 1, np.zeros((9, 8)), 1,
+                1, 2)
+
+
+def _advect_5min_numpy(q, noise, ensemble, dt, U, dx, V, dy, T_steps,
+                       wind_size, scratch_a, scratch_b):
+    """advect_5min for when numba is not installed. Every field is advanced
+    in place with time_deriv_3 using the scratch arrays scratch_a and
+    scratch_b, which are allocated here if they are None, and flux arrays
+    which are allocated once per call."""
+    domain_shape = q.shape
+    ens_size = ensemble.shape[0]
+    q = q.copy()
+    noise = noise.astype(q.dtype)
+    if scratch_a is None:
+        scratch_a = np.empty_like(q)
+        scratch_b = np.empty_like(q)
+    F_x = np.empty_like(U)
+    F_y = np.empty_like(V)
     for t in range(T_steps):
-        q = time_deriv_3(q, dt, U, dx, V, dy)
-        noise = time_deriv_3(noise, dt, U, dx, V, dy)
-        for ens_index in range(ens_size):
-            ensemble[wind_size:, ens_index] = time_deriv_3(
-                ensemble[wind_size:, ens_index].reshape(domain_shape), dt,
-                U + ensemble[0, ens_index], dx,
-                V + ensemble[1, ens_index], dy).reshape(domain_size)
+        time_deriv_3(q, dt, U, dx, V, dy, scratch_a, scratch_b, F_x, F_y)
+        time_deriv_3(noise, dt, U, dx, V, dy, scratch_a, scratch_b, F_x, F_y)
+    members = ensemble[:, wind_size:].reshape((ens_size,) + domain_shape)
+    for ens_index in range(ens_size):
+        member_U = U + ensemble[ens_index, 0]
+        member_V = V + ensemble[ens_index, 1]
+        for t in range(T_steps):
+            time_deriv_3(members[ens_index], dt, member_U, dx, member_V, dy,
+                         scratch_a, scratch_b, F_x, F_y)
     return q, noise, ensemble
 
 
@@ -444,8 +774,10 @@ def find_flat_loc(sat, sensor_loc):
 def get_flat_correct(
         cloud_height, lat_step, lon_step, domain_shape, sat_azimuth,
         sat_elevation, location, sensor_time):
-
-
+    """Returns the shift of the raveled sensor indices due to parallax at
+    sensor_time. sensor_time may be a single time or a DatetimeIndex, in which
+    case the solar position is computed in one call and an array with one
+    correction per time is returned."""
     solar_position = location.get_solarposition(sensor_time)
     x_correct, y_correct = parallax_shift(
         cloud_height, sat_azimuth, sat_elevation,
@@ -453,8 +785,8 @@ def get_flat_correct(
         solar_position['elevation'].values)
     lat_correct, lon_correct = to_lat_lon(x_correct, y_correct,
                                           location.latitude)
-    west_east_correct = int(np.round(lon_correct/lon_step))
-    south_north_correct = int(np.round(lat_correct/lat_step))
+    west_east_correct = np.round(lon_correct/lon_step).astype(int)
+    south_north_correct = np.round(lat_correct/lat_step).astype(int)
     flat_correct = west_east_correct + south_north_correct*domain_shape[0]
     return flat_correct
 
@@ -470,16 +802,14 @@ def simulation_parallax(sat, wind, sensor_data, sensor_loc, start_time,
                   .tz_localize('MST').astype(int))
     all_time = sat.time.values
     time_range = np.intersect1d(time_range, all_time)
-    sat_loc = np.concatenate(
-        (sat['lat'].values.ravel()[:, None],
-         sat['long'].values.ravel()[:, None]), axis=1)
     domain_shape = sat['clear_sky_good'].isel(time=0).shape
     noise_init = noise_fun(domain_shape)
     assimilation_positions, assimilation_positions_2d, full_positions_2d = (
         assimilation_position_generator(domain_shape, assimilation_grid_size))
-    ## This is only for now. Eventually H will be a function of time and cloud height.
-    # H, delete = forward_obs_mat(sensor_loc[['lat', 'lon']].values, sat_loc)
-    # H = np.concatenate((np.zeros((H.shape[0], 2)), H), axis=1)
+    local_indices, local_mask = build_local_index_table(
+        assimilation_positions_2d, domain_shape, localization_length)
+    interpolation_matrix = build_interpolation_matrix(
+        assimilation_positions_2d, full_positions_2d, np.float32)
     flat_sensor_loc, lat_step, lon_step = find_flat_loc(
         sat, sensor_loc)
 
@@ -487,64 +817,91 @@ def simulation_parallax(sat, wind, sensor_data, sensor_loc, start_time,
         sat['clear_sky_good'].sel(time=time_range[0]).values,
         CI_sigma=CI_sigma, wind_size=wind_size,
         wind_sigma=wind_sigma, ens_size=ens_size)
-    q = sat['clear_sky_good'].sel(time=time_range[0]).values
+    q = sat['clear_sky_good'].sel(time=time_range[0]).values.astype(
+        np.float32)
     noise = noise_init.copy()
-    background = ensemble.mean(axis=1)[None, :]
-    analysis = background.copy()
-    advected = q[None, :, :].copy()
+    advection_numbers = (np.diff(time_range)*(10**(-9)/(60*5))).astype(int)
+    total_steps = advection_numbers.sum()
+    advected = np.empty((total_steps + 1,) + domain_shape, dtype=np.float32)
+    background = np.empty((total_steps + 1, ensemble.shape[1]),
+                          dtype=np.float32)
+    analysis = np.empty_like(background)
+    ensemble_scratch = np.empty_like(ensemble)
+    scratch_a = np.empty(domain_shape, dtype=np.float32)
+    scratch_b = np.empty(domain_shape, dtype=np.float32)
+    _compile_advection(np.float32)
+    advected[0] = q
+    background[0] = ensemble.mean(axis=0)
+    analysis[0] = background[0]
+    step = 0
+    # the time of every assimilated step, its parallax correction and its
+    # sensor values are found up front so the solar position is only
+    # calculated once and the loop does no pandas indexing. Step 0 is not
+    # assimilated, so row step - 1 belongs to step.
+    sensor_times = pd.DatetimeIndex(
+        time_range[0] + np.arange(1, total_steps + 1)*5*60*10**9
+    ).tz_localize('UTC').tz_convert('MST')
+    flat_corrects = get_flat_correct(
+        cloud_height=cloud_height, lat_step=lat_step, lon_step=lon_step,
+        domain_shape=domain_shape, sat_azimuth=sat_azimuth,
+        sat_elevation=sat_elevation,
+        location=location, sensor_time=sensor_times)
+    # .loc raises a KeyError if a time is missing from sensor_data rather
+    # than assimilating NaN observations for it
+    sensor_array = sensor_data.loc[sensor_times].values.astype(np.float32)
     for time_index in range(time_range.size - 1):
         sat_time = time_range[time_index]
         print('time_index: ' + str(time_index))
-        U = wind.sel(time=sat_time, method='pad').U.values
-        V = wind.sel(time=sat_time, method='pad').V.values
+        U = wind.sel(time=sat_time, method='pad').U.values.astype(np.float32)
+        V = wind.sel(time=sat_time, method='pad').V.values.astype(np.float32)
         cx = abs(U).max()
         cy = abs(V).max()
         T_steps = int(np.ceil((5*60)*(cx/dx+cy/dy)/C_max))
         dt = (5*60)/T_steps
-        advection_number = int((time_range[time_index + 1] -
-                                time_range[time_index])*(10**(-9)/(60*5)))
+        advection_number = advection_numbers[time_index]
         for n in range(advection_number):
-            sensor_time = pd.Timestamp(
-                sat_time + (n + 1)*5*60*10**9).tz_localize('UTC'
-                ).tz_convert('MST')
             print('advection_number: ' + str(n))
             q, noise, ensemble = advect_5min(q, noise, ensemble, dt, U, dx,
-                                             V, dy, T_steps, wind_size)
-            advected = np.concatenate([advected, q[None, :, :]], axis=0)
-            background = np.concatenate(
-                [background, ensemble.mean(axis=1)[None,:]], axis=0)
-            flat_correct = get_flat_correct(
-                cloud_height=cloud_height, lat_step=lat_step, lon_step=lon_step,
-                domain_shape=domain_shape, sat_azimuth=sat_azimuth,
-                sat_elevation=sat_elevation,
-                location=location, sensor_time=sensor_time)
-            this_flat_sensor_loc = flat_sensor_loc + flat_correct
-            ensemble = assimilate_parallax(ensemble, sensor_data.ix[sensor_time],
-                                  this_flat_sensor_loc + wind_size,
-                                           1/sensor_sig**2, 1)
-            if n != advection_number-1:
-                analysis = np.concatenate(
-                    [analysis, ensemble.mean(axis=1)[None, :]], axis=0)
+                                             V, dy, T_steps, wind_size,
+                                             scratch_a=scratch_a,
+                                             scratch_b=scratch_b)
+            step += 1
+            advected[step] = q
+            # the ensemble mean is taken once before and once after each
+            # assimilation and passed on instead of being recomputed
+            background[step] = ensemble.mean(axis=0)
+            this_flat_sensor_loc = flat_sensor_loc + flat_corrects[step - 1]
+            assimilate_parallax(ensemble, sensor_array[step - 1],
+                                this_flat_sensor_loc + wind_size,
+                                1/sensor_sig**2, 1, x_bar=background[step],
+                                out=ensemble_scratch)
+            analysis[step] = ensemble.mean(axis=0)
 
         # for whole image assimilation
-        q = sat['clear_sky_good'].sel(time=time_range[time_index + 1]).values
-        noise = (noise - noise.min())
-        noise = noise/noise.max()
+        q = sat['clear_sky_good'].sel(
+            time=time_range[time_index + 1]).values.astype(np.float32)
         noise = noise.ravel()
-        ensemble[wind_size::] = (q.ravel()[:, None]*noise[:, None] +
-                                 ensemble[wind_size:, :]*(1 - noise[:, None]))
-        ensemble[wind_size::] = assimilate(
-            ensemble=ensemble[wind_size::],
+        np.subtract(noise, noise.min(), out=noise)
+        np.divide(noise, noise.max(), out=noise)
+        state = ensemble[:, wind_size:]
+        np.multiply(state, (1 - noise)[None, :], out=state)
+        state += (q.ravel()*noise)[None, :]
+        # the blend is linear so it is applied to the mean as well
+        state_bar = analysis[step, wind_size:]*(1 - noise) + q.ravel()*noise
+        assimilate_parallax(
+            ensemble=ensemble[:, wind_size:],
             observations=sat['clear_sky_good'].sel(
                 time=time_range[time_index + 1]).values.ravel(),
-            H=None, R_inverse=1/sat_sig**2, inflation=1,
+            flat_sensor_indices=None, R_inverse=1/sat_sig**2, inflation=1,
             domain_shape=domain_shape,
             localization_length=localization_length,
             assimilation_positions=assimilation_positions,
             assimilation_positions_2d=assimilation_positions_2d,
-            full_positions_2d=full_positions_2d)
-        analysis = np.concatenate(
-            [analysis, ensemble.mean(axis=1)[None, :]], axis=0)
+            full_positions_2d=full_positions_2d,
+            local_indices=local_indices, local_mask=local_mask,
+            interpolation_matrix=interpolation_matrix,
+            x_bar=state_bar, out=ensemble_scratch[:, wind_size:])
+        analysis[step] = ensemble.mean(axis=0)
         noise = noise_init.copy()
     begining = time_range[0]
     end = time_range[-1]
@@ -580,7 +937,7 @@ def test_parallax(sat, sensor_data, sensor_loc, start_time,
                 location=location, sensor_time=sat_time)
         this_flat_sensor_loc = flat_sensor_loc + flat_correct
         error[time_index] = (q[this_flat_sensor_loc] -
-                             sensor_data.ix[sat_time].values)
+                             sensor_data.loc[sat_time].values)
         solar_position = location.get_solarposition(sat_time)
         x_correct, y_correct = parallax_shift(
             cloud_height, sat_azimuth, sat_elevation,
@@ -1,7 +1,25 @@
+import math
+import os
+import re
+from functools import lru_cache, partial
 import numpy as np
 import pandas as pd
 import xarray as xr
-from glob import glob
+from _compat import HAS_NUMBA, njit, prange
+try:
+    import numexpr as ne
+    HAS_NUMEXPR = True
+except ImportError:
+    HAS_NUMEXPR = False
+try:
+    import cupy as cp
+    HAS_CUPY = True
+except ImportError:
+    HAS_CUPY = False
+
+# projected grids of sphere_to_lcc(..., cache=True), oldest first
+_grid_cache = {}
+_grid_cache_size = 8
 
 def get_all_files(start_hour=11, end_hour=3):
     """
@@ -12,84 +30,461 @@ def get_all_files(start_hour=11, end_hour=3):
                                 np.arange(0, end_hour + 1))
     else:
         hour_range = np.arange(start_hour, end_hour)
-    files = []
-    for hour in hour_range:
-        temp = glob(
-            ('/a2/uaren/goes_images/april/goes15.2014.*.{hour:02d}*.BAND_01.nc'
-                          .format(hour=hour)))
-        files = files + temp
-        temp = glob(
-            ('/a2/uaren/goes_images/may/goes15.2014.*.{hour:02d}*.BAND_01.nc'
-                          .format(hour=hour)))
-        files = files + temp
-        temp = glob(
-            ('/a2/uaren/goes_images/june/goes15.2014.*.{hour:02d}*.BAND_01.nc'
-                          .format(hour=hour)))
-        files = files + temp
-    files.sort(key = lambda x: x.sort('.2014.')[1])
+    # each month directory is listed once and the names are filtered by hour
+    # here instead of globbing the directory again for every hour
+    listings = {}
+    for month in ('april', 'may', 'june'):
+        directory = '/a2/uaren/goes_images/{month}'.format(month=month)
+        try:
+            listings[directory] = os.listdir(directory)
+        except FileNotFoundError:
+            listings[directory] = []
+    patterns = {
+        hour: re.compile(r'goes15\.2014\..*\.{hour:02d}.*\.BAND_01\.nc$'
+                         .format(hour=hour))
+        for hour in hour_range}
+    files = [os.path.join(directory, name)
+             for hour in hour_range
+             for directory, names in listings.items()
+             for name in names if patterns[hour].match(name)]
+    # sort by the day and time which follow the year in the file name
+    files.sort(key=lambda path: path.split('.2014.', 1)[1])
     return files
 
 
-def sphere_to_lcc(self, lats, lons, R=6370, truelat0=31.7, truelat1=31.7,
-                  ref_lat=31.68858, stand_lon=-113.7):
+def open_all(files, chunks=None):
+    """
+    Lazily opens files, for example the output of get_all_files, as one
+    dataset concatenated along time. The files are opened in parallel with
+    dask and each file is one chunk unless chunks says otherwise. Variables
+    without a time dimension, like the lat/lon grid, are taken from the first
+    file instead of being read from every file and compared.
+    """
+    if chunks is None:
+        chunks = {}
+    return xr.open_mfdataset(files, concat_dim='time', combine='nested',
+                             data_vars='minimal', coords='minimal',
+                             compat='override', parallel=True, chunks=chunks)
+
+
+def convert_to_zarr(files, store, time_chunk=24, space_chunk=512):
+    """
+    Writes files, for example the output of get_all_files, into the Zarr
+    store so that later runs open one store with xr.open_zarr and select
+    times with .sel instead of opening every NetCDF file.
+
+    Variables with a time dimension are stored in blocks of time_chunk
+    times and space_chunk x space_chunk pixels, compressed with zstd. Longer
+    time chunks make extracting a time series cheaper but reading a single
+    image more expensive; the defaults keep a float32 block near 25 MB.
+    """
+    import zarr
+    ds = open_all(files)
+    ds = ds.chunk({dim: time_chunk if dim == 'time' else space_chunk
+                   for dim in ds.dims})
+    # the NetCDF encodings describe the first file only, e.g. its time units
+    # and chunk sizes, so they are dropped and xarray picks new ones
+    for variable in ds.variables.values():
+        variable.encoding = {}
+    # zarr 3 takes a tuple of its own codecs while zarr 2 takes one numcodecs
+    # compressor
+    if int(zarr.__version__.split('.')[0]) >= 3:
+        compression = {'compressors': (zarr.codecs.BloscCodec(
+            cname='zstd', clevel=3, shuffle='shuffle'),)}
+    else:
+        from numcodecs import Blosc
+        compression = {'compressor': Blosc(cname='zstd', clevel=3,
+                                           shuffle=Blosc.SHUFFLE)}
+    encoding = {name: dict(compression)
+                for name, variable in ds.data_vars.items()
+                if 'time' in variable.dims}
+    ds.to_zarr(store, mode='w', encoding=encoding, consolidated=True)
+
+
+@lru_cache(maxsize=8)
+def _lcc_constants(truelat0, truelat1, ref_lat, stand_lon, dtype=np.float64):
+    """Returns the cone constant n, F, rho0 and lambda0 (in radians) of the
+    Lambert conformal projection used by sphere_to_lcc and lcc_to_sphere.
+    They only depend on the projection parameters so they are cached. They
+    are computed with the scalar math functions in float64 and returned as
+    scalars of dtype so that they do not upcast float32 arrays."""
+    phi0 = math.radians(ref_lat)
+    phi1 = math.radians(truelat0)
+    phi2 = math.radians(truelat1)
+    lambda0 = math.radians(stand_lon)
+
+    if truelat0 == truelat1:
+        n = math.sin(phi0)
+    else:
+        n = (math.log(math.cos(phi1) / math.cos(phi2)) /
+             math.log(math.tan(math.pi / 4 + phi2 / 2) /
+                      math.tan(math.pi / 4 + phi1 / 2)
+                      ))
+    F = (math.cos(phi1) * math.pow(math.tan(math.pi / 4 + phi1 / 2), n) / n)
+    rho0 = F / math.pow(math.tan(math.pi / 4 + phi0 / 2), n)
+    dtype = np.dtype(dtype).type
+    return dtype(n), dtype(F), dtype(rho0), dtype(lambda0)
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _sphere_to_lcc_nb(lats, lons, n, F, rho0, lambda0, R, x, y):
+    """Fused version of sphere_to_lcc for flat arrays which writes the
+    projected coordinates into x and y."""
+    for i in prange(lats.shape[0]):
+        phi = math.radians(lats[i])
+        rho = F * math.exp(-n * math.log(math.tan(math.pi / 4 + phi / 2)))
+        ang = n * (math.radians(lons[i]) - lambda0)
+        x[i] = R * rho * math.sin(ang)
+        y[i] = R * (rho0 - rho * math.cos(ang))
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _lcc_to_sphere_nb(x, y, n, F, rho0, lambda0, R, lats, lons):
+    """Fused version of lcc_to_sphere for flat arrays which writes the
+    latitudes and longitudes into lats and lons."""
+    inv_n = 1.0 / n
+    F_root = F**inv_n
+    for i in prange(x.shape[0]):
+        x_i = x[i] / R
+        y_i = y[i] / R
+        rho = math.sqrt(x_i**2 + (y_i - rho0)**2)
+        rho_root = math.exp(math.log(rho) * inv_n)
+        phi = 2 * (math.atan2(F_root, rho_root) - math.pi / 4)
+        lats[i] = math.degrees(phi)
+        lons[i] = math.degrees(math.atan2(x_i, rho0 - y_i) / n + lambda0)
+
+
+if HAS_CUPY:
+    @cp.fuse()
+    def _sphere_to_lcc_fused(lats, lons, n, F, rho0, lambda0, R):
+        """sphere_to_lcc for cupy arrays as a single fused GPU kernel."""
+        rho = F * cp.exp(-n * cp.log(cp.tan(math.pi / 4 +
+                                             cp.radians(lats) / 2)))
+        ang = n * (cp.radians(lons) - lambda0)
+        return R * rho * cp.sin(ang), R * (rho0 - rho * cp.cos(ang))
+
+    @cp.fuse()
+    def _lcc_to_sphere_fused(x, y, n, inv_n, F_root, rho0, lambda0, R):
+        """lcc_to_sphere for cupy arrays as a single fused GPU kernel."""
+        x_scaled = x / R
+        y_scaled = rho0 - y / R
+        rho = cp.sqrt(x_scaled * x_scaled + y_scaled * y_scaled)
+        rho_root = cp.exp(cp.log(rho) * inv_n)
+        phis = 2 * (cp.arctan2(F_root, rho_root) - math.pi / 4)
+        lambdas = cp.arctan2(x_scaled, y_scaled) / n + lambda0
+        return cp.degrees(phis), cp.degrees(lambdas)
+
+
+def _on_gpu(a, b):
+    """Returns True if a or b is a cupy array."""
+    return HAS_CUPY and (isinstance(a, cp.ndarray) or
+                         isinstance(b, cp.ndarray))
+
+
+def _working_dtype(a, b, dtype):
+    """Returns dtype or, if it is None, the floating point type of a and b,
+    which is float32 only if both of them are float32."""
+    if dtype is None:
+        # the dtype attribute is used so that cupy arrays are not copied to
+        # the host to find it
+        dtypes = [value.dtype if hasattr(value, 'dtype')
+                  else np.asarray(value).dtype for value in (a, b)]
+        dtype = np.result_type(*dtypes, np.float32)
+    return np.dtype(dtype)
+
+
+def _checked_pair(a, b, dtype):
+    """Returns a and b as C contiguous arrays of dtype, converting them only
+    if they are not already, and raises a ValueError right away if their
+    shapes do not broadcast against each other."""
+    a = np.asarray(a, dtype=dtype, order='C')
+    b = np.asarray(b, dtype=dtype, order='C')
+    if a.shape != b.shape:
+        try:
+            np.broadcast(a, b)
+        except ValueError:
+            raise ValueError('shapes {} and {} do not broadcast'.format(
+                a.shape, b.shape))
+    return a, b
+
+
+def _flat_pair(a, b, dtype):
+    """Broadcasts a and b against each other and returns them as flat
+    contiguous arrays of dtype along with their shape."""
+    a, b = np.broadcast_arrays(np.asarray(a, dtype=dtype),
+                               np.asarray(b, dtype=dtype))
+    return (np.ascontiguousarray(a).ravel(), np.ascontiguousarray(b).ravel(),
+            a.shape)
+
+
+def _grid_key(lats, lons, *params):
+    """Returns a key for _grid_cache made from the shape and dtype of lats
+    and lons, their edges and about a thousand values spread over them, and
+    the projection parameters. Only this sample is read so the key is cheap
+    to find for large grids, but two grids which only differ away from the
+    sampled values get the same key."""
+    key = []
+    for array in (lats, lons):
+        flat = array.ravel()
+        grid = np.atleast_2d(array)
+        sample = np.concatenate([flat[::max(1, flat.size // 1024)],
+                                 grid[:1].ravel(), grid[-1:].ravel(),
+                                 grid[..., :1].ravel(),
+                                 grid[..., -1:].ravel()])
+        key.append((array.shape, array.dtype.str, sample.tobytes()))
+    return tuple(key), params
+
+
+def sphere_to_lcc(lats, lons, R=6370, truelat0=31.7, truelat1=31.7,
+                  ref_lat=31.68858, stand_lon=-113.7, dtype=None,
+                  cache=False):
     """
     Taken from Tony Lorenzo's repository at:
     https://github.com/alorenzo175/
          satellite_irradiance_optimal_interpolation.git.
     Convert from spherical lats/lons like what comes out of WRF to the WRF
     Lambert Conformal x/y coordinates. Defaults are what
-    are generally used for the AZ domain
+    are generally used for the AZ domain. The arithmetic is done in dtype,
+    which defaults to float32 for float32 lats and lons and float64 otherwise.
+    If cache is True the result is kept for the last few grids, keyed on
+    their shape and a sample of their values, and returned as read only
+    arrays when the same grid is projected again, which is the case for
+    every file of a GOES archive.
+    If lats or lons is a cupy array the projection is done on the GPU and
+    cupy arrays are returned.
     """
-    phis = np.radians(lats)
-    lambdas = np.radians(lons)
-    phi0 = np.radians(ref_lat)
-    phi1 = np.radians(truelat0)
-    phi2 = np.radians(truelat1)
-    lambda0 = np.radians(stand_lon)
+    dtype = _working_dtype(lats, lons, dtype)
+    if _on_gpu(lats, lons):
+        n, F, rho0, lambda0 = _lcc_constants(truelat0, truelat1, ref_lat,
+                                             stand_lon, dtype)
+        return _sphere_to_lcc_fused(cp.asarray(lats, dtype=dtype),
+                                    cp.asarray(lons, dtype=dtype), n, F,
+                                    rho0, lambda0, dtype.type(R))
+    lats, lons = _checked_pair(lats, lons, dtype)
+    if cache:
+        key = _grid_key(lats, lons, R, truelat0, truelat1, ref_lat,
+                        stand_lon, dtype.str)
+        if key not in _grid_cache:
+            x, y = sphere_to_lcc(lats, lons, R=R, truelat0=truelat0,
+                                 truelat1=truelat1, ref_lat=ref_lat,
+                                 stand_lon=stand_lon, dtype=dtype)
+            x.flags.writeable = False
+            y.flags.writeable = False
+            if len(_grid_cache) >= _grid_cache_size:
+                del _grid_cache[next(iter(_grid_cache))]
+            _grid_cache[key] = x, y
+        return _grid_cache[key]
+    n, F, rho0, lambda0 = _lcc_constants(truelat0, truelat1, ref_lat,
+                                         stand_lon, dtype)
+    R = dtype.type(R)
+    if HAS_NUMBA:
+        lats, lons, shape = _flat_pair(lats, lons, dtype)
+        x = np.empty(lats.size, dtype=dtype)
+        y = np.empty(lats.size, dtype=dtype)
+        _sphere_to_lcc_nb(lats, lons, n, F, rho0, lambda0, R, x, y)
+        return x.reshape(shape), y.reshape(shape)
+    if HAS_NUMEXPR:
+        # numexpr has no radians so the conversion factor is passed in
+        local_dict = dict(lats=lats, lons=lons, n=n, F=F, rho0=rho0,
+                          lambda0=lambda0, R=R, d2r=dtype.type(np.pi / 180),
+                          quarter_pi=dtype.type(np.pi / 4))
+        local_dict['rho'] = ne.evaluate(
+            'F * exp(-n * log(tan(quarter_pi + lats * d2r / 2)))', local_dict)
+        local_dict['ang'] = ne.evaluate('n * (lons * d2r - lambda0)',
+                                        local_dict)
+        x = ne.evaluate('R * rho * sin(ang)', local_dict)
+        y = ne.evaluate('R * (rho0 - rho * cos(ang))', local_dict)
+        return x, y
+    # the outputs and rho are the only arrays allocated, every step is
+    # written into one of them
+    shape = np.broadcast(lats, lons).shape
+    x = np.empty(shape, dtype=dtype)
+    y = np.empty(shape, dtype=dtype)
+    rho = np.empty(shape, dtype=dtype)
+    # rho = F * tan(pi / 4 + phis / 2)**(-n)
+    np.radians(lats, out=rho)
+    np.divide(rho, 2, out=rho)
+    np.add(rho, np.pi / 4, out=rho)
+    np.tan(rho, out=rho)
+    # tan**(-n) as exp(-n * log(tan)) since exp and log are much faster
+    # than pow with a non integer exponent
+    np.log(rho, out=rho)
+    np.multiply(rho, -n, out=rho)
+    np.exp(rho, out=rho)
+    np.multiply(rho, F, out=rho)
+    # ang = n * (lambdas - lambda0) is kept in y
+    np.radians(lons, out=y)
+    np.subtract(y, lambda0, out=y)
+    np.multiply(y, n, out=y)
+    # x = R * rho * sin(ang)
+    np.sin(y, out=x)
+    np.multiply(x, rho, out=x)
+    np.multiply(x, R, out=x)
+    # y = R * (rho0 - rho * cos(ang))
+    np.cos(y, out=y)
+    np.multiply(y, rho, out=y)
+    np.subtract(rho0, y, out=y)
+    np.multiply(y, R, out=y)
 
-    if truelat0 == truelat1:
-        n = np.sin(phi0)
+    return x, y
+
+
+def sphere_to_lcc_packed(latlon, out=None, R=6370, truelat0=31.7,
+                         truelat1=31.7, ref_lat=31.68858, stand_lon=-113.7):
+    """
+    sphere_to_lcc for an array latlon whose last axis of length 2 holds the
+    latitude and longitude of each point. x and y are written into the last
+    axis of out, which is allocated like latlon if it is None, and out is
+    returned. With numba the kernel reads and writes the interleaved arrays
+    directly so nothing else is allocated.
+    """
+    dtype = _working_dtype(latlon, latlon, None)
+    latlon = np.asarray(latlon, dtype=dtype)
+    if out is None:
+        out = np.empty(latlon.shape, dtype=dtype)
+    if HAS_NUMBA and out.flags.c_contiguous:
+        n, F, rho0, lambda0 = _lcc_constants(truelat0, truelat1, ref_lat,
+                                             stand_lon, dtype)
+        latlon = latlon.reshape(-1, 2)
+        flat_out = out.reshape(-1, 2)
+        _sphere_to_lcc_nb(latlon[:, 0], latlon[:, 1], n, F, rho0, lambda0,
+                          dtype.type(R), flat_out[:, 0], flat_out[:, 1])
     else:
-        n = (np.log(np.cos(phi1) / np.cos(phi2)) /
-             np.log(np.tan(np.pi / 4 + phi2 / 2) /
-                    np.tan(np.pi / 4 + phi1 / 2)
-                    ))
-    F = (np.cos(phi1) * np.power(np.tan(np.pi / 4 + phi1 / 2), n) / n)
-    rho0 = F / np.power(np.tan(np.pi / 4 + phi0 / 2), n)
-    rho = F / np.power(np.tan(np.pi / 4 + phis / 2), n)
-    x = R * rho * np.sin(n * (lambdas - lambda0))
-    y = R * (rho0 - rho * np.cos(n * (lambdas - lambda0)))
+        out[..., 0], out[..., 1] = sphere_to_lcc(
+            latlon[..., 0], latlon[..., 1], R=R, truelat0=truelat0,
+            truelat1=truelat1, ref_lat=ref_lat, stand_lon=stand_lon,
+            dtype=dtype)
+    return out
 
-    return x, y
 
-def lcc_to_sphere(self, x, y, R=6370, truelat0=31.7, truelat1=31.7,
-                  ref_lat=31.68858, stand_lon=-113.7):
+def lcc_to_sphere(x, y, R=6370, truelat0=31.7, truelat1=31.7,
+                  ref_lat=31.68858, stand_lon=-113.7, dtype=None):
     """
     Taken from Tony Lorenzo's repository at:
     https://github.com/alorenzo175/
          satellite_irradiance_optimal_interpolation.git.
     Convert from spherical lats/lons like what comes out of WRF to the WRF
     Lambert Conformal x/y coordinates. Defaults are what
-    are generally used for the AZ domain
+    are generally used for the AZ domain. The arithmetic is done in dtype,
+    which defaults to float32 for float32 x and y and float64 otherwise.
+    If x or y is a cupy array the projection is done on the GPU and cupy
+    arrays are returned.
     """
-    phi0 = np.radians(ref_lat)
-    phi1 = np.radians(truelat0)
-    phi2 = np.radians(truelat1)
-    lambda0 = np.radians(stand_lon)
+    dtype = _working_dtype(x, y, dtype)
+    n, F, rho0, lambda0 = _lcc_constants(truelat0, truelat1, ref_lat,
+                                         stand_lon, dtype)
+    R = dtype.type(R)
+    # F**(1 / n) is a scalar so it is only computed once
+    inv_n = 1 / n
+    F_root = F**inv_n
+    if _on_gpu(x, y):
+        return _lcc_to_sphere_fused(cp.asarray(x, dtype=dtype),
+                                    cp.asarray(y, dtype=dtype), n, inv_n,
+                                    F_root, rho0, lambda0, R)
+    x, y = _checked_pair(x, y, dtype)
+    if HAS_NUMBA:
+        x, y, shape = _flat_pair(x, y, dtype)
+        lats = np.empty(x.size, dtype=dtype)
+        lons = np.empty(x.size, dtype=dtype)
+        _lcc_to_sphere_nb(x, y, n, F, rho0, lambda0, R, lats, lons)
+        return lats.reshape(shape), lons.reshape(shape)
+    if HAS_NUMEXPR:
+        # numexpr has no degrees so the conversion factor is passed in
+        local_dict = dict(x=x, y=y, n=n, inv_n=inv_n, F_root=F_root,
+                          rho0=rho0, lambda0=lambda0, R=R,
+                          r2d=dtype.type(180 / np.pi),
+                          quarter_pi=dtype.type(np.pi / 4))
+        local_dict['rho'] = ne.evaluate('sqrt((x / R)**2 + (y / R - rho0)**2)',
+                                        local_dict)
+        lats = ne.evaluate(
+            '2 * (arctan2(F_root, exp(log(rho) * inv_n)) - quarter_pi) * r2d',
+            local_dict)
+        lons = ne.evaluate(
+            '(arctan2(x / R, rho0 - y / R) / n + lambda0) * r2d', local_dict)
+        return lats, lons
+    # the outputs and rho are the only arrays allocated, every step is
+    # written into one of them
+    shape = np.broadcast(x, y).shape
+    lats = np.empty(shape, dtype=dtype)
+    lons = np.empty(shape, dtype=dtype)
+    rho = np.empty(shape, dtype=dtype)
+    # rho = sqrt((x / R)**2 + (rho0 - y / R)**2) with x / R kept in lons
+    # and rho0 - y / R kept in lats
+    np.divide(x, R, out=lons)
+    np.divide(y, R, out=lats)
+    np.subtract(rho0, lats, out=lats)
+    np.hypot(lons, lats, out=rho)
+    # lambdas = arctan2(x / R, rho0 - y / R) / n + lambda0
+    np.arctan2(lons, lats, out=lons)
+    np.divide(lons, n, out=lons)
+    np.add(lons, lambda0, out=lons)
+    np.degrees(lons, out=lons)
+    # phis = 2 * (arctan2(F**(1 / n), rho**(1 / n)) - pi / 4)
+    # rho**(1 / n) as exp(log(rho) / n)
+    np.log(rho, out=rho)
+    np.multiply(rho, inv_n, out=rho)
+    np.exp(rho, out=rho)
+    np.arctan2(F_root, rho, out=lats)
+    np.subtract(lats, np.pi / 4, out=lats)
+    np.multiply(lats, 2, out=lats)
+    np.degrees(lats, out=lats)
 
-    if truelat0 == truelat1:
-        n = np.sin(phi0)
-    else:
-        n = (np.log(np.cos(phi1) / np.cos(phi2)) /
-             np.log(np.tan(np.pi / 4 + phi2 / 2) /
-                    np.tan(np.pi / 4 + phi1 / 2)
-                    ))
-    F = (np.cos(phi1) * np.power(np.tan(np.pi / 4 + phi1 / 2), n) / n)
-    rho0 = F / np.power(np.tan(np.pi / 4 + phi0 / 2), n)
-    x = x / R
-    y = y /R
-    rho = np.sqrt(x**2 + (y - rho0)**2)
-    phis = 2 * (np.arctan2(F**(1.0 / n), rho**(1.0 / n)) - np.pi / 4)
-    lambdas = np.arcsin(x / rho) / n + lambda0
-
-    return np.degrees(phis), np.degrees(lambdas)
+    return lats, lons
+
+
+def make_lcc_projector(R=6370, truelat0=31.7, truelat1=31.7,
+                       ref_lat=31.68858, stand_lon=-113.7):
+    """
+    Returns the functions forward(lats, lons) and inverse(x, y) which do
+    what sphere_to_lcc and lcc_to_sphere do for one fixed projection. With
+    numba the projection constants are found once per dtype and the
+    functions go straight to the cached kernels, skipping the dispatch of
+    sphere_to_lcc and lcc_to_sphere. Without numba the functions are
+    sphere_to_lcc and lcc_to_sphere with the parameters bound.
+    """
+    params = dict(R=R, truelat0=truelat0, truelat1=truelat1, ref_lat=ref_lat,
+                  stand_lon=stand_lon)
+    if not HAS_NUMBA:
+        return partial(sphere_to_lcc, **params), partial(lcc_to_sphere,
+                                                         **params)
+    constants = {}
+
+    def bound_constants(dtype):
+        if dtype not in constants:
+            constants[dtype] = _lcc_constants(
+                truelat0, truelat1, ref_lat, stand_lon, dtype) + (
+                    dtype.type(R),)
+        return constants[dtype]
+
+    def forward(lats, lons, dtype=None):
+        dtype = _working_dtype(lats, lons, dtype)
+        lats, lons = _checked_pair(lats, lons, dtype)
+        lats, lons, shape = _flat_pair(lats, lons, dtype)
+        x = np.empty(lats.size, dtype=dtype)
+        y = np.empty(lats.size, dtype=dtype)
+        _sphere_to_lcc_nb(lats, lons, *bound_constants(dtype), x, y)
+        return x.reshape(shape), y.reshape(shape)
+
+    def inverse(x, y, dtype=None):
+        dtype = _working_dtype(x, y, dtype)
+        x, y = _checked_pair(x, y, dtype)
+        x, y, shape = _flat_pair(x, y, dtype)
+        lats = np.empty(x.size, dtype=dtype)
+        lons = np.empty(x.size, dtype=dtype)
+        _lcc_to_sphere_nb(x, y, *bound_constants(dtype), lats, lons)
+        return lats.reshape(shape), lons.reshape(shape)
+
+    return forward, inverse
+
+
+def project_dataset(ds, lat='lat', lon='lon', dtype=np.float32, **kwargs):
+    """
+    Applies sphere_to_lcc to the lat and lon variables of ds, which may be
+    backed by dask as from open_all, and returns x and y as DataArrays. With
+    dask the projection is done lazily and in parallel chunk by chunk.
+    kwargs are passed on to sphere_to_lcc.
+    """
+    kwargs['dtype'] = dtype
+    return xr.apply_ufunc(sphere_to_lcc, ds[lat], ds[lon], kwargs=kwargs,
+                          output_core_dims=[[], []], dask='parallelized',
+                          output_dtypes=[dtype, dtype])
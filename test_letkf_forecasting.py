@@ -0,0 +1,236 @@
+"""
+Regression tests which pin the rewritten kernels of letkf_forecasting to the
+original implementations.
+
+    python -m pytest -q
+"""
+import numpy as np
+import pytest
+from scipy import interpolate
+
+import letkf_forecasting as lf
+
+
+def original_time_deriv_3(q, dt, u, dx, v, dy):
+    """time_deriv_3 as it was before the kernels were rewritten."""
+    k = original_space_deriv_4(q, u, dx, v, dy)
+    k = original_space_deriv_4(q + dt/3*k, u, dx, v, dy)
+    k = original_space_deriv_4(q + dt/2*k, u, dx, v, dy)
+    qout = q + dt*k
+    return qout
+
+
+def original_space_deriv_4(q, u, dx, v, dy):
+    """space_deriv_4 as it was before the kernels were rewritten."""
+    qout = np.zeros_like(q)
+    F_x = np.zeros_like(u)
+    F_y = np.zeros_like(v)
+
+    # middle calculation
+    F_x[:, 2:-2] = u[:, 2:-2]/12*(
+        7*(q[:, 2:-1] + q[:, 1:-2]) - (q[:, 3:] + q[:, :-3]))
+    F_y[2:-2, :] = v[2:-2, :]/12*(
+        7*(q[2:-1, :] + q[1:-2, :]) - (q[3:, :] + q[:-3, :]))
+    qout[:, 2:-2] = qout[:, 2:-2] - (F_x[:, 3:-2] - F_x[:, 2:-3])/dx
+    qout[2:-2, :] = qout[2:-2, :] - (F_y[3:-2, :] - F_y[2:-3, :])/dy
+
+    # boundary calculation
+    u_w = u[:, 0:2].clip(max=0)
+    u_e = u[:, -2:].clip(min=0)
+    qout[:, 0:2] = qout[:, 0:2] - ((u_w/dx)*(
+        q[:, 1:3] - q[:, 0:2]) + (q[:, 0:2]/dx)*(u[:, 1:3] - u[:, 0:2]))
+    qout[:, -2:] = qout[:, -2:] - ((u_e/dx)*(
+        q[:, -2:] - q[:, -3:-1]) + (q[:, -2:]/dx)*(u[:, -2:] - u[:, -3:-1]))
+
+    v_n = v[-2:, :].clip(min=0)
+    v_s = v[0:2, :].clip(max=0)
+    qout[0:2, :] = qout[0:2, :] - ((v_s/dx)*(
+        q[1:3, :] - q[0:2, :]) + (q[0:2, :]/dx)*(v[1:3, :] - v[0:2, :]))
+    qout[-2:, :] = qout[-2:, :] - ((v_n/dx)*(
+        q[-2:, :] - q[-3:-1, :]) + (q[-2:, :]/dx)*(v[-2:, :] - v[-3:-1, :]))
+
+    return qout
+
+
+def _advect_reference(q, dt, U, dx, V, dy, T_steps):
+    for t in range(T_steps):
+        q = original_time_deriv_3(q, dt, U, dx, V, dy)
+    return q
+
+
+@pytest.fixture
+def winds():
+    rng = np.random.default_rng(0)
+    shape = (45, 50)
+    q = rng.random(shape)
+    U = rng.normal(size=(shape[0], shape[1] + 1))
+    V = rng.normal(size=(shape[0] + 1, shape[1]))
+    return q, U, V
+
+
+needs_numba = pytest.mark.skipif(not lf.HAS_NUMBA,
+                                 reason='numba is not installed')
+
+
+@needs_numba
+@pytest.mark.parametrize('T_steps', [1, 6, 7])
+def test_advect_ensemble_matches_time_deriv_3(winds, T_steps):
+    q, U, V = winds
+    rng = np.random.default_rng(1)
+    du = rng.normal(size=3)*0.3
+    dv = rng.normal(size=3)*0.3
+    members = np.stack([q, q**2, 1 - q])
+    expected = [_advect_reference(member, 0.05, U + du[m], 1., V + dv[m], 1.,
+                                  T_steps)
+                for m, member in enumerate(members)]
+    dts, inv_ds = lf._advection_scalars(0.05, 1., 1., members.dtype)
+    lf._advect_ensemble_nb(members, dts, U, du, V, dv, inv_ds, T_steps)
+    np.testing.assert_allclose(members, expected, rtol=0, atol=1e-12)
+
+
+@pytest.fixture(params=['numba', 'numpy'])
+def advection_path(request, monkeypatch):
+    """Forces advect_5min down the numba or the NumPy path."""
+    if request.param == 'numba' and not lf.HAS_NUMBA:
+        pytest.skip('numba is not installed')
+    monkeypatch.setattr(lf, 'HAS_NUMBA', request.param == 'numba')
+    return request.param
+
+
+def test_advect_5min_matches_original(winds, advection_path):
+    q, U, V = winds
+    rng = np.random.default_rng(2)
+    noise = rng.random(q.shape)
+    wind_size = 2
+    ensemble = np.concatenate([rng.normal(size=(4, wind_size))*0.3,
+                               rng.random((4, q.size))], axis=1)
+    expected_q = _advect_reference(q, 0.05, U, 1., V, 1., 5)
+    expected_noise = _advect_reference(noise, 0.05, U, 1., V, 1., 5)
+    # the original looped over the members, advecting each with its own wind
+    expected_ensemble = ensemble.copy()
+    for member in expected_ensemble:
+        member[wind_size:] = _advect_reference(
+            member[wind_size:].reshape(q.shape), 0.05, U + member[0], 1.,
+            V + member[1], 1., 5).ravel()
+    new_q, new_noise, new_ensemble = lf.advect_5min(
+        q, noise, ensemble, 0.05, U, 1., V, 1., 5, wind_size)
+    np.testing.assert_allclose(new_q, expected_q, rtol=0, atol=1e-12)
+    np.testing.assert_allclose(new_noise, expected_noise, rtol=0, atol=1e-12)
+    np.testing.assert_allclose(new_ensemble, expected_ensemble, rtol=0,
+                               atol=1e-12)
+
+
+def test_advect_5min_mixed_dtypes(winds, advection_path):
+    q, U, V = winds
+    rng = np.random.default_rng(5)
+    ensemble = np.concatenate([rng.normal(size=(3, 2))*0.3,
+                               rng.random((3, q.size))], axis=1)
+    expected_q = _advect_reference(q, 0.05, U, 1., V, 1., 3)
+    expected_member = _advect_reference(
+        ensemble[0, 2:].reshape(q.shape), 0.05, U + ensemble[0, 0], 1.,
+        V + ensemble[0, 1], 1., 3)
+    # float32 fields with a float64 ensemble and winds
+    q = q.astype(np.float32)
+    new_q, new_noise, new_ensemble = lf.advect_5min(
+        q, q.copy(), ensemble, 0.05, U, 1., V, 1., 3, 2)
+    assert new_q.dtype == new_noise.dtype == np.float32
+    assert new_ensemble.dtype == np.float64
+    np.testing.assert_allclose(new_q, expected_q, rtol=0, atol=1e-5)
+    np.testing.assert_allclose(new_ensemble[0, 2:].reshape(q.shape),
+                               expected_member, rtol=0, atol=1e-5)
+
+
+@pytest.mark.parametrize('in_place', [False, True])
+def test_time_deriv_3_matches_original(winds, in_place):
+    q, U, V = winds
+    expected = original_time_deriv_3(q, 0.05, U, 1.5, V, 2.)
+    if in_place:
+        advanced = q.copy()
+        result = lf.time_deriv_3(advanced, 0.05, U, 1.5, V, 2.,
+                                 np.empty_like(q), np.empty_like(q),
+                                 np.empty_like(U), np.empty_like(V))
+        assert result is advanced
+    else:
+        original_q = q.copy()
+        result = lf.time_deriv_3(q, 0.05, U, 1.5, V, 2.)
+        np.testing.assert_array_equal(q, original_q)
+    np.testing.assert_allclose(result, expected, rtol=0, atol=1e-12)
+
+
+@pytest.mark.parametrize('diagonal_R', [False, True])
+def test_localized_assimilation_matches_loop(diagonal_R):
+    rng = np.random.default_rng(4)
+    domain_shape = (23, 19)
+    ens_size = 6
+    localization_length = 3
+    ensemble = rng.random((ens_size, domain_shape[0]*domain_shape[1]))
+    if diagonal_R:
+        # the diagonal of R_inverse over the state
+        R_inverse = 1/rng.uniform(0.03, 0.1, ensemble.shape[1])**2
+        R_diagonal = R_inverse
+    else:
+        R_inverse = 1/0.05**2
+        R_diagonal = np.full(ensemble.shape[1], R_inverse)
+    observations = rng.random(ensemble.shape[1])
+    assimilation_positions, assimilation_positions_2d, full_positions_2d = (
+        lf.assimilation_position_generator(domain_shape, 4))
+
+    # the original loop over assimilation positions
+    x_bar = ensemble.mean(axis=0)
+    perturbations = (ensemble - x_bar).T
+    W_interp = np.zeros([assimilation_positions.size, ens_size**2])
+    for count, position in enumerate(assimilation_positions):
+        local_positions = lf.nearest_positions(position, domain_shape,
+                                               localization_length)
+        local_ensemble = perturbations[local_positions]
+        C = local_ensemble.T*R_diagonal[local_positions]
+        eig_value, eig_vector = np.linalg.eigh(
+            (ens_size - 1)*np.eye(ens_size) + C.dot(local_ensemble))
+        P_tilde = (eig_vector/eig_value).dot(eig_vector.T)
+        W_a = (eig_vector/np.sqrt(eig_value)).dot(eig_vector.T)*np.sqrt(
+            ens_size - 1)
+        W_a += P_tilde.dot(C.dot(observations[local_positions] -
+                                 x_bar[local_positions]))[:, None]
+        W_interp[count] = W_a.ravel()
+    W_fine_mesh = interpolate.LinearNDInterpolator(
+        assimilation_positions_2d, W_interp)(full_positions_2d)
+    expected = x_bar[:, None] + np.einsum(
+        'ij,ijk->ik', perturbations,
+        W_fine_mesh.reshape(-1, ens_size, ens_size))
+
+    analysis = lf.assimilate_parallax(
+        ensemble.copy(), observations, None, R_inverse, 1,
+        domain_shape=domain_shape, localization_length=localization_length,
+        assimilation_positions=assimilation_positions,
+        assimilation_positions_2d=assimilation_positions_2d,
+        full_positions_2d=full_positions_2d, batch_size=7)
+    np.testing.assert_allclose(analysis, expected.T, rtol=0, atol=1e-12)
+
+
+def test_local_index_table_matches_nearest_positions():
+    domain_shape = (23, 19)
+    localization_length = 3
+    assimilation_positions, assimilation_positions_2d, _ = (
+        lf.assimilation_position_generator(domain_shape, 4))
+    local_indices, local_mask = lf.build_local_index_table(
+        assimilation_positions_2d, domain_shape, localization_length)
+    for count, position in enumerate(assimilation_positions):
+        np.testing.assert_array_equal(
+            np.sort(local_indices[count][local_mask[count]]),
+            lf.nearest_positions(position, domain_shape, localization_length))
+
+
+@pytest.mark.parametrize('dtype, atol', [(np.float64, 1e-12),
+                                         (np.float32, 1e-6)])
+def test_interpolation_matrix_matches_linear_interpolator(dtype, atol):
+    rng = np.random.default_rng(3)
+    _, assimilation_positions_2d, full_positions_2d = (
+        lf.assimilation_position_generator((23, 19), 4))
+    values = rng.random((assimilation_positions_2d.shape[0], 5))
+    expected = interpolate.LinearNDInterpolator(
+        assimilation_positions_2d, values)(full_positions_2d)
+    interpolation_matrix = lf.build_interpolation_matrix(
+        assimilation_positions_2d, full_positions_2d, dtype)
+    assert interpolation_matrix.dtype == dtype
+    np.testing.assert_allclose(interpolation_matrix.dot(values), expected,
+                               rtol=0, atol=atol)
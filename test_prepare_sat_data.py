@@ -0,0 +1,186 @@
+"""
+Regression tests which pin the rewritten projections of prepare_sat_data to
+the original formulas.
+
+    python -m pytest -q
+"""
+import numpy as np
+import pytest
+
+import prepare_sat_data as psd
+
+
+def original_sphere_to_lcc(lats, lons, R=6370, truelat0=31.7, truelat1=31.7,
+                           ref_lat=31.68858, stand_lon=-113.7):
+    """sphere_to_lcc as it was first taken from Tony Lorenzo's repository."""
+    phis = np.radians(lats)
+    lambdas = np.radians(lons)
+    phi0 = np.radians(ref_lat)
+    phi1 = np.radians(truelat0)
+    phi2 = np.radians(truelat1)
+    lambda0 = np.radians(stand_lon)
+    if truelat0 == truelat1:
+        n = np.sin(phi0)
+    else:
+        n = (np.log(np.cos(phi1) / np.cos(phi2)) /
+             np.log(np.tan(np.pi / 4 + phi2 / 2) /
+                    np.tan(np.pi / 4 + phi1 / 2)))
+    F = (np.cos(phi1) * np.power(np.tan(np.pi / 4 + phi1 / 2), n) / n)
+    rho0 = F / np.power(np.tan(np.pi / 4 + phi0 / 2), n)
+    rho = F / np.power(np.tan(np.pi / 4 + phis / 2), n)
+    x = R * rho * np.sin(n * (lambdas - lambda0))
+    y = R * (rho0 - rho * np.cos(n * (lambdas - lambda0)))
+    return x, y
+
+
+def original_lcc_to_sphere(x, y, R=6370, truelat0=31.7, truelat1=31.7,
+                           ref_lat=31.68858, stand_lon=-113.7):
+    """lcc_to_sphere as it was first taken from Tony Lorenzo's repository,
+    with the arcsin longitude."""
+    phi0 = np.radians(ref_lat)
+    phi1 = np.radians(truelat0)
+    phi2 = np.radians(truelat1)
+    lambda0 = np.radians(stand_lon)
+    if truelat0 == truelat1:
+        n = np.sin(phi0)
+    else:
+        n = (np.log(np.cos(phi1) / np.cos(phi2)) /
+             np.log(np.tan(np.pi / 4 + phi2 / 2) /
+                    np.tan(np.pi / 4 + phi1 / 2)))
+    F = (np.cos(phi1) * np.power(np.tan(np.pi / 4 + phi1 / 2), n) / n)
+    rho0 = F / np.power(np.tan(np.pi / 4 + phi0 / 2), n)
+    x = x / R
+    y = y / R
+    rho = np.sqrt(x**2 + (y - rho0)**2)
+    phis = 2 * (np.arctan2(F**(1.0 / n), rho**(1.0 / n)) - np.pi / 4)
+    lambdas = np.arcsin(x / rho) / n + lambda0
+    return np.degrees(phis), np.degrees(lambdas)
+
+
+@pytest.fixture
+def az_grid():
+    """A dense lat/lon grid covering the AZ domain."""
+    lons, lats = np.meshgrid(np.linspace(-115, -108.5, 400),
+                             np.linspace(31, 37.5, 300))
+    return lats, lons
+
+
+@pytest.fixture(params=['numba', 'numexpr', 'numpy'])
+def projection_path(request, monkeypatch):
+    """Forces sphere_to_lcc and lcc_to_sphere down one of their CPU paths."""
+    if request.param == 'numba' and not psd.HAS_NUMBA:
+        pytest.skip('numba is not installed')
+    if request.param == 'numexpr' and not psd.HAS_NUMEXPR:
+        pytest.skip('numexpr is not installed')
+    monkeypatch.setattr(psd, 'HAS_NUMBA', request.param == 'numba')
+    monkeypatch.setattr(psd, 'HAS_NUMEXPR', request.param == 'numexpr')
+    return request.param
+
+
+@pytest.mark.parametrize('truelats', [(31.7, 31.7), (30., 60.)])
+def test_projection_matches_original(az_grid, projection_path, truelats):
+    lats, lons = az_grid
+    kwargs = dict(truelat0=truelats[0], truelat1=truelats[1])
+    expected_x, expected_y = original_sphere_to_lcc(lats, lons, **kwargs)
+    x, y = psd.sphere_to_lcc(lats, lons, **kwargs)
+    np.testing.assert_allclose(x, expected_x, rtol=1e-12, atol=1e-9)
+    np.testing.assert_allclose(y, expected_y, rtol=1e-12, atol=1e-9)
+
+    expected_lats, expected_lons = original_lcc_to_sphere(x, y, **kwargs)
+    new_lats, new_lons = psd.lcc_to_sphere(x, y, **kwargs)
+    np.testing.assert_allclose(new_lats, expected_lats, rtol=0, atol=1e-10)
+    np.testing.assert_allclose(new_lons, expected_lons, rtol=0, atol=1e-10)
+    np.testing.assert_allclose(new_lats, lats, rtol=0, atol=1e-10)
+    np.testing.assert_allclose(new_lons, lons, rtol=0, atol=1e-10)
+
+
+def test_projection_float32_round_trip(az_grid, projection_path):
+    lats, lons = az_grid
+    x, y = psd.sphere_to_lcc(lats.astype(np.float32), lons.astype(np.float32))
+    assert x.dtype == y.dtype == np.float32
+    expected_x, expected_y = original_sphere_to_lcc(lats, lons)
+    np.testing.assert_allclose(x, expected_x, rtol=1e-5, atol=1e-2)
+    np.testing.assert_allclose(y, expected_y, rtol=1e-5, atol=1e-2)
+    new_lats, new_lons = psd.lcc_to_sphere(x, y)
+    assert new_lats.dtype == new_lons.dtype == np.float32
+    np.testing.assert_allclose(new_lats, lats, rtol=0, atol=1e-4)
+    np.testing.assert_allclose(new_lons, lons, rtol=0, atol=1e-4)
+
+
+@pytest.mark.parametrize('dtype, rtol, atol', [(np.float64, 1e-12, 1e-9),
+                                               (np.float32, 1e-6, 1e-3)])
+def test_packed_projection_matches_sphere_to_lcc(az_grid, dtype, rtol, atol):
+    lats, lons = az_grid
+    latlon = np.stack([lats, lons], axis=-1).astype(dtype)
+    expected_x, expected_y = psd.sphere_to_lcc(latlon[..., 0], latlon[..., 1])
+    out = psd.sphere_to_lcc_packed(latlon)
+    assert out.shape == latlon.shape and out.dtype == dtype
+    np.testing.assert_allclose(out[..., 0], expected_x, rtol=rtol, atol=atol)
+    np.testing.assert_allclose(out[..., 1], expected_y, rtol=rtol, atol=atol)
+    # an out which is not contiguous takes the other path
+    out = np.empty(latlon.shape[::-1], dtype=dtype).T
+    assert psd.sphere_to_lcc_packed(latlon, out=out) is out
+    np.testing.assert_allclose(out[..., 0], expected_x, rtol=rtol, atol=atol)
+    np.testing.assert_allclose(out[..., 1], expected_y, rtol=rtol, atol=atol)
+
+
+def test_grid_cache(az_grid, monkeypatch):
+    monkeypatch.setattr(psd, '_grid_cache', {})
+    lats, lons = az_grid
+    x, y = psd.sphere_to_lcc(lats, lons, cache=True)
+    assert not x.flags.writeable and not y.flags.writeable
+    expected_x, expected_y = psd.sphere_to_lcc(lats, lons)
+    np.testing.assert_array_equal(x, expected_x)
+    np.testing.assert_array_equal(y, expected_y)
+    # an equal grid is found in the cache
+    assert psd.sphere_to_lcc(lats.copy(), lons.copy(), cache=True)[0] is x
+    # another grid, dtype or projection is projected again
+    assert psd.sphere_to_lcc(lats + 0.1, lons, cache=True)[0] is not x
+    assert psd.sphere_to_lcc(lats, lons, dtype=np.float32,
+                             cache=True)[0] is not x
+    assert psd.sphere_to_lcc(lats, lons, truelat1=40.,
+                             cache=True)[0] is not x
+    assert len(psd._grid_cache) == 4
+
+
+@pytest.mark.parametrize('truelats', [(31.7, 31.7), (30., 60.)])
+@pytest.mark.parametrize('dtype', [np.float64, np.float32])
+def test_projector_matches_sphere_to_lcc(az_grid, projection_path, truelats,
+                                         dtype):
+    lats, lons = (value.astype(dtype) for value in az_grid)
+    kwargs = dict(truelat0=truelats[0], truelat1=truelats[1])
+    forward, inverse = psd.make_lcc_projector(**kwargs)
+    x, y = forward(lats, lons)
+    expected_x, expected_y = psd.sphere_to_lcc(lats, lons, **kwargs)
+    assert x.dtype == y.dtype == dtype
+    np.testing.assert_array_equal(x, expected_x)
+    np.testing.assert_array_equal(y, expected_y)
+    new_lats, new_lons = inverse(x, y)
+    expected_lats, expected_lons = psd.lcc_to_sphere(x, y, **kwargs)
+    np.testing.assert_array_equal(new_lats, expected_lats)
+    np.testing.assert_array_equal(new_lons, expected_lons)
+    with pytest.raises(ValueError):
+        forward(np.ones(3), np.ones(4))
+
+
+@pytest.mark.skipif(not psd.HAS_CUPY, reason='cupy is not installed')
+def test_projection_on_gpu(az_grid):
+    lats, lons = az_grid
+    x, y = psd.sphere_to_lcc(psd.cp.asarray(lats), lons)
+    assert isinstance(x, psd.cp.ndarray)
+    expected_x, expected_y = original_sphere_to_lcc(lats, lons)
+    np.testing.assert_allclose(x.get(), expected_x, rtol=1e-12, atol=1e-9)
+    np.testing.assert_allclose(y.get(), expected_y, rtol=1e-12, atol=1e-9)
+    new_lats, new_lons = psd.lcc_to_sphere(x, y)
+    assert isinstance(new_lats, psd.cp.ndarray)
+    np.testing.assert_allclose(new_lats.get(), lats, rtol=0, atol=1e-10)
+    np.testing.assert_allclose(new_lons.get(), lons, rtol=0, atol=1e-10)
+
+
+def test_projection_shapes():
+    x, y = psd.sphere_to_lcc(32.2, -110.9)
+    assert np.shape(x) == np.shape(y) == ()
+    x, y = psd.sphere_to_lcc(np.full((3, 4), 32.2), -110.9)
+    assert x.shape == y.shape == (3, 4)
+    with pytest.raises(ValueError):
+        psd.sphere_to_lcc(np.ones(3), np.ones(4))